@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the WinView/WinSpec reader in spespec.py.
+
+Synthetic .spe files are generated for every combination of data type,
+frame size, frame count and ROI layout, then the reader is timed on them:
+
+  header     read_header() alone
+  load       SPECFile(path), the full cube into memory
+  mmap_open  SPECFile(path, mmap=True)
+  first      latency to the first frame (mmap open + read_frames(0, 1))
+  stream     iter_frames() over the whole file
+  rois       splitting an open file into its ROI views (SPECFile.rois)
+
+together with the peak memory allocated by the full load and its
+throughput in MB/s.  Every timing is the best of --repeat runs; the files
+have just been written, so these are warm page cache numbers.  Results go
+to a JSON file which a later run can be compared against:
+
+  python spebench.py -o base.json
+  ... change spespec.py ...
+  python spebench.py -o new.json --compare base.json
+
+Timings below --min-time are too noisy to count as regressions, they are
+only listed.
+
+@author: kshmirko
+"""
+
+from __future__ import division, print_function
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+
+from spespec import SPECFile, SPEWriter, read_header, dtROI
+
+
+DTYPES=[np.float32, np.int32, np.int16, np.uint16]
+
+# (name, nframes, ydim, xdim)
+SIZES=[
+    ('spectrum', 1, 1, 1340),
+    ('kinetics', 200, 100, 1340),
+    ('image', 20, 512, 512),
+]
+
+ROIS=[1, 4]
+
+
+def make_synthetic(path, dtype, nframes, ydim, xdim, rois=1, seed=0):
+    """Write a .spe file of noisy frames, split into rois row bands.
+
+    Frames are written one at a time, so files larger than memory can be
+    generated.
+    """
+    rng=np.random.RandomState(seed)
+    with SPEWriter(path, xdim, ydim, dtype) as w:
+        hdr=w.header
+        hdr.NumROI=rois
+        bounds=np.linspace(0, ydim, rois+1).astype(int)
+        blocks=np.zeros(len(hdr.ROIinfoblk), dtype=dtROI)
+        for i in range(rois):
+            blocks[i]=(1, xdim, 1, bounds[i]+1, bounds[i+1], 1)
+        hdr.ROIinfoblk=blocks
+
+        info=np.iinfo(dtype) if np.dtype(dtype).kind in 'iu' else None
+        for i in range(nframes):
+            frame=rng.poisson(100.0, size=(ydim, xdim))
+            if info is not None:
+                frame=np.clip(frame, info.min, info.max)
+            w.append(frame.astype(dtype))
+
+
+def best(func, repeat):
+    """Smallest wall time of repeat calls of func."""
+    times=[]
+    for i in range(repeat):
+        t0=time.perf_counter()
+        func()
+        times.append(time.perf_counter()-t0)
+    return min(times)
+
+
+def peak_memory(func):
+    """Peak bytes allocated (as seen by tracemalloc) while func runs."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_case(path, repeat):
+    size=os.path.getsize(path)
+
+    def first():
+        SPECFile(path, mmap=True).read_frames(0, 1)
+
+    def stream():
+        for frames in SPECFile(path, mmap=True).iter_frames(16):
+            pass
+
+    opened=SPECFile(path, mmap=True)
+    load=best(lambda: SPECFile(path), repeat)
+    return {
+        'bytes': size,
+        'header_s': best(lambda: read_header(path), repeat),
+        'load_s': load,
+        'mmap_open_s': best(lambda: SPECFile(path, mmap=True), repeat),
+        'first_s': best(first, repeat),
+        'stream_s': best(stream, repeat),
+        'rois_s': best(lambda: opened.rois, repeat),
+        'load_peak_bytes': peak_memory(lambda: SPECFile(path)),
+        'load_mb_s': size/load/1e6 if load else float('inf'),
+    }
+
+
+def run(directory, repeat, scale=1):
+    results=[]
+    for dtype in DTYPES:
+        for name, nframes, ydim, xdim in SIZES:
+            nframes=max(1, int(nframes*scale))
+            for rois in ROIS:
+                if rois>ydim:
+                    continue
+                case='%s-%s-%dx%dx%d-roi%d' % (name, np.dtype(dtype).name,
+                                               nframes, ydim, xdim, rois)
+                path=os.path.join(directory, case+'.spe')
+                make_synthetic(path, dtype, nframes, ydim, xdim, rois)
+                result={'case': case, 'dtype': np.dtype(dtype).name,
+                        'nframes': nframes, 'ydim': ydim, 'xdim': xdim,
+                        'rois': rois}
+                result.update(run_case(path, repeat))
+                os.remove(path)
+                results.append(result)
+                print('%-40s load %8.4f s %9.1f MB/s  first %8.5f s' % (
+                    case, result['load_s'], result['load_mb_s'],
+                    result['first_s']))
+    return results
+
+
+def compare(results, baseline, tolerance=0.1, min_time=1e-3):
+    """Print time ratios against a baseline run; return the regressions.
+    
+    A slowdown only counts as a regression when the new time is at least
+    min_time seconds.
+    """
+    old=dict((r['case'], r) for r in baseline['results'])
+    slower=[]
+    for r in results:
+        b=old.get(r['case'])
+        if b is None:
+            continue
+        for key in ('header_s', 'load_s', 'first_s', 'stream_s', 'rois_s'):
+            if key not in b:
+                continue
+            ratio=r[key]/b[key] if b[key] else float('inf')
+            if ratio>1+tolerance and r[key]>=min_time:
+                slower.append((r['case'], key, ratio))
+            print('%-40s %-10s %6.2fx' % (r['case'], key, ratio))
+    return slower
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-o', '--output', default='spebench.json',
+                        help='JSON file for the results')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-s', '--scale', type=float, default=1.0,
+                        help='multiply the frame counts')
+    parser.add_argument('-d', '--directory',
+                        help='where to write the synthetic files')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+                        help='JSON results of an earlier run')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('-m', '--min-time', type=float, default=1e-3,
+                        help='shortest time in seconds a regression may have')
+    args=parser.parse_args(argv)
+
+    directory=args.directory or tempfile.mkdtemp(prefix='spebench')
+    try:
+        results=run(directory, args.repeat, args.scale)
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory)
+
+    with open(args.output, 'w') as fd:
+        json.dump({'meta': {'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'platform': platform.platform(),
+                            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                            'repeat': args.repeat,
+                            'scale': args.scale},
+                   'results': results}, fd, indent=1)
+
+    if args.compare:
+        with open(args.compare) as fd:
+            slower=compare(results, json.load(fd), args.tolerance,
+                           args.min_time)
+        for case, key, ratio in slower:
+            print('REGRESSION %s %s %.2fx' % (case, key, ratio))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -338,48 +338,1682 @@ Created on Sat Sep 29 08:40:06 2012
 """
 
 from __future__ import division, with_statement, print_function
-import scipy as sc
+import os
+import sys
+import time
+import fnmatch
+import weakref
+import hashlib
+import warnings
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, partial
+import numpy as np
+
+# asyncio, concurrent.futures and tracemalloc are imported where they are
+# used, they would otherwise add more to the import time than numpy itself
 
 #__all__ = ["SPECFile"]
 
+# size of the file header, the data starts right after it
+_DATA_OFFSET=4100
+
+# size of the raw buffer used when converting data while reading
+_CHUNK_BYTES=1<<22
+
+
+class _Record(object):
+    """Attribute access to a numpy record with decoded, cached fields.
+    
+    Strings are cut at the first NUL and decoded, nested structures are
+    wrapped in turn.  Decoded values are cached on first access; assigning
+    to a field writes through to the underlying record.
+    """
+    
+    def __init__(self, record):
+        object.__setattr__(self, '_record', record)
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # cached under the field name, so that setting it through any of
+        # its names drops the cached value
+        name=_HEADER_ALIASES.get(name, name)
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            pass
+        value=_decode(getattr(self._record, name))
+        self.__dict__[name]=value
+        return value
+    
+    def __setattr__(self, name, value):
+        name=_HEADER_ALIASES.get(name, name)
+        if name not in self._record.dtype.names:
+            raise AttributeError("no header field %r" % (name,))
+        setattr(self._record, name, value)
+        self.__dict__.pop(name, None)
+    
+    def __getitem__(self, name):
+        # header['xdim'] like on the numpy.record, decoded like header.xdim
+        if _HEADER_ALIASES.get(name, name) not in self._record.dtype.names:
+            raise KeyError(name)
+        return getattr(self, name)
+    
+    def __setitem__(self, name, value):
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            raise KeyError(name)
+    
+    def __getstate__(self):
+        return self._record
+    
+    def __setstate__(self, record):
+        object.__setattr__(self, '_record', record)
+    
+    @property
+    def record(self):
+        """The underlying numpy.record."""
+        return self._record
+    
+    @property
+    def dtype(self):
+        return self._record.dtype
+
+
+class SPEHeader(_Record):
+    """The 4100-byte file header parsed from a buffer without copying."""
+    
+    def __init__(self, buf):
+        _Record.__init__(self, np.frombuffer(buf, dtype=(np.record, dtHEADER),
+                                             count=1)[0])
+    
+    def tobytes(self):
+        return self._record.tobytes()
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.split(b'\0', 1)[0].decode('latin-1')
+    if isinstance(value, np.record):
+        return _Record(value)
+    if isinstance(value, np.generic):
+        # plain Python numbers, numpy's uint16 xdim*ydim would overflow
+        return value.item()
+    if isinstance(value, np.ndarray) and value.dtype.kind=='S':
+        return [_decode(v) for v in value.tolist()]
+    return value
+
 
 class SPECFile(object):
     
-    def __init__(self, arg):
+    # ReadStats of the file when instrumented, see __init__
+    stats=None
+    # (factor, offset) applied to the counts while reading and the dtype
+    # they are converted to, None for raw frames; see _fromfile
+    _scale=(1.0, 0.0)
+    _dtype=None
+    
+    def __init__(self, arg, mmap=False, stats=None, dtype=None, scale=False,
+                 cache=None):
+        """Read a WinView/WinSpec file from a path or an open binary file.
+        
+        With mmap=True the header is parsed but the data is not read:
+        frames becomes a read-only numpy.memmap over the data section and
+        pages are loaded only when they are accessed.
+        
+        dtype converts the data while it is read, chunk by chunk into the
+        final array, so the raw cube is never held next to the converted
+        one.  scale=True additionally applies the absolute scaling
+        offset+factor*counts of the YCal structure, scale="x" or "y" picks
+        the calibration structure and a (factor, offset) pair gives it
+        explicitly; an unset factor of 0 counts as 1.  Scaled data without
+        a dtype is float32 (float64 for 32-bit integer files).  Frames read
+        again later, through iter_frames, read_frames, read_region or
+        select_by_delay, are converted the same way.
         
-        if isinstance(arg, basestring):
+        With stats=True the reads are timed and counted in self.stats, a
+        ReadStats; stats may also be a callable receiving the ReadStats
+        once the file is loaded.  The default is the callback installed
+        with set_stats_callback.
+        
+        cache=True takes the frames from the process-wide FrameCache (see
+        frame_cache), cache may also be a FrameCache of its own.  Cached
+        frames are read-only and shared by all files opened on the same,
+        unchanged path.
+        """
+        
+        if mmap and (dtype is not None or scale is not False):
+            raise ValueError("dtype and scale need the data to be read, "
+                             "they cannot be combined with mmap")
+        if cache and (mmap or dtype is not None or scale is not False or
+                      not _ispath(arg)):
+            raise ValueError("only raw frames of files given by name can be "
+                             "cached, without mmap, dtype or scale")
+        
+        if _ispath(arg):
+            arg=os.fspath(arg)
+        self._source=arg
+        self._startstats(stats, arg)
+        if _ispath(arg):
             with open(arg, "rb") as fd:
-                self._fromfile(fd)
+                if cache:
+                    self._readheader(fd)
+                    cache=frame_cache() if cache is True else cache
+                    self.frames=cache.get(arg)
+                elif mmap:
+                    self._frommap(fd)
+                else:
+                    self._fromfile(fd, dtype, scale)
         elif hasattr(arg, 'seek'):
-            self._fromfile(arg)
-            
-    def _fromfile(self, fileid):
-        self.header=sc.rec.fromfile(fileid, dtype=_HEADER_1, shape=1, byteorder='<')[0]
-        dtype=self.get_dtype(self.header.datatype)
+            if mmap:
+                self._frommap(arg)
+            else:
+                self._fromfile(arg, dtype, scale)
+        self._finishstats(stats)
+    
+    def _startstats(self, stats, source):
+        if stats is None:
+            stats=_stats_callback
+        if stats:
+            self.stats=ReadStats(source if _ispath(source)
+                                 else getattr(source, 'name', None))
+    
+    def _finishstats(self, stats):
+        if self.stats is None:
+            return
+        self.stats.finish()
+        if stats is None:
+            stats=_stats_callback
+        if callable(stats):
+            stats(self.stats)
+    
+    def _read(self, fd, out, field='read_s'):
+        # _readinto, counted in self.stats when instrumented
+        if self.stats is None:
+            return _readinto(fd, out)
+        t0=time.perf_counter()
+        _readinto(fd, out)
+        self.stats.add(field, time.perf_counter()-t0, memoryview(out).nbytes)
+        return out
+    
+    @classmethod
+    async def aopen(cls, path, mmap=False, executor=None, **kwargs):
+        """Coroutine version of SPECFile(path), loading in an executor.
+        
+        Further keyword arguments (dtype, scale, stats, cache) are passed
+        on to SPECFile().  At most max_open_files() files are read at the
+        same time per event loop, the others wait their turn.
+        """
+        import asyncio
+        loop=asyncio.get_running_loop()
+        async with _open_semaphore():
+            return await loop.run_in_executor(executor,
+                                              partial(cls, path, mmap=mmap,
+                                                      **kwargs))
+    
+    async def aiter_frames(self, chunk=1, executor=None):
+        """Async iterator over iter_frames(chunk), each read in an executor.
+        
+        A chunk is read only when the consumer asks for it, so a slow
+        consumer throttles the reads, and the yielded buffer is reused as
+        in iter_frames.  The file counts against max_open_files() while
+        the iteration runs.
+        """
+        import asyncio
+        loop=asyncio.get_running_loop()
+        async with _open_semaphore():
+            frames=self.iter_frames(chunk)
+            step=None
+
+            def close(step):
+                if not step.cancelled():
+                    step.exception()
+                frames.close()
+
+            try:
+                while True:
+                    step=loop.run_in_executor(executor, next, frames, None)
+                    # shielded so that cancelling us leaves step pending
+                    # for as long as the worker is inside the generator
+                    block=await asyncio.shield(step)
+                    if block is None:
+                        break
+                    yield block
+            finally:
+                if step is not None and not step.done():
+                    # cancelled mid-read, close once the worker lets go
+                    step.add_done_callback(close)
+                else:
+                    frames.close()
+    
+    def _readheader(self, fileid):
+        self.header=SPEHeader(self._read(fileid, bytearray(_DATA_OFFSET),
+                                         'header_s'))
+        
+    def _fromfile(self, fileid, dtype=None, scale=False):
+        self._readheader(fileid)
+        raw=_frame_dtype(self.header.datatype)
+        xdim=self.header.xdim
+        ydim=self.header.ydim
+        nfram=self.header.NumFrames
+        factor, offset=self._scaling(scale)
+        self._scale=(float(factor), float(offset))
+        
+        if (dtype is None or np.dtype(dtype)==raw) and factor==1 and offset==0:
+            # readinto works on any binary stream, fromfile needs a real file
+            self.frames=self._read(fileid, np.empty((nfram, ydim, xdim,), dtype=raw))
+            return
+        
+        if dtype is None:
+            # scaled counts do not fit the integer types of the file, the
+            # float is wide enough for every count of raw
+            dtype=raw if factor==1 and offset==0 else np.promote_types(raw, np.float32)
+        self._dtype=np.dtype(dtype)
+        # convert through a small raw buffer into the final array
+        out=np.empty((nfram, ydim, xdim,), dtype=dtype)
+        chunk=max(1, _CHUNK_BYTES//max(1, xdim*ydim*raw.itemsize))
+        buf=np.empty((min(chunk, nfram), ydim, xdim,), dtype=raw)
+        for start in range(0, nfram, chunk):
+            n=min(chunk, nfram-start)
+            self._read(fileid, buf[:n])
+            self._convert(buf[:n], out[start:start+n])
+        self.frames=out
+    
+    def _convert(self, raw, out=None):
+        # raw counts as read from the file in the dtype and scaling the file
+        # was opened with, so that re-reads agree with self.frames
+        if self._dtype is None:
+            return raw
+        if out is None:
+            out=np.empty(raw.shape, dtype=self._dtype)
+        factor, offset=self._scale
+        t0=time.perf_counter()
+        if factor==1 and offset==0:
+            out[...]=raw
+        elif out.dtype.kind=='f':
+            np.multiply(raw, factor, out=out, casting='unsafe')
+            out+=offset
+        else:
+            out[...]=raw*factor+offset
+        if self.stats is not None:
+            self.stats.add('convert_s', time.perf_counter()-t0)
+        return out
+    
+    def _scaling(self, scale):
+        # (factor, offset) requested by the scale argument
+        if scale is False or scale is None:
+            return 1, 0
+        if scale is True or scale=="y":
+            cal=self.header.YCal
+        elif scale=="x":
+            cal=self.header.XCal
+        else:
+            factor, offset=scale
+            return factor, offset
+        return (float(cal.factor) or 1.0), float(cal.offset)
+    
+    @classmethod
+    def from_buffer(cls, buf, stats=None):
+        """Wrap an in-memory file (bytes, bytearray, memoryview, mmap...).
+        
+        Header and frames are numpy views of buf, nothing is copied; they
+        are read-only unless buf is writable and keep buf alive.  stats is
+        as for SPECFile().
+        """
+        self=cls.__new__(cls)
+        self._startstats(stats, None)
+        self._frombuffer(buf)
+        self._finishstats(stats)
+        return self
+    
+    def _frombuffer(self, buf):
+        t0=time.perf_counter()
+        mv=memoryview(buf).cast('B')
+        self._source=_BufferFile(mv)
+        self.header=SPEHeader(mv[:_DATA_OFFSET])
+        if self.stats is not None:
+            self.stats.add('header_s', time.perf_counter()-t0)
+        
+        t0=time.perf_counter()
+        dtype=_frame_dtype(self.header.datatype)
+        # Python ints, so that the size products below cannot overflow
+        shape=tuple(int(n) for n in (self.header.NumFrames, self.header.ydim,
+                                     self.header.xdim))
+        data=np.frombuffer(mv, dtype=dtype, count=shape[0]*shape[1]*shape[2],
+                           offset=_DATA_OFFSET)
+        self.frames=data.reshape(shape)
+        if self.stats is not None:
+            self.stats.add('convert_s', time.perf_counter()-t0)
+    
+    def _frommap(self, fileid):
+        fileid.seek(0)
+        self._readheader(fileid)
+        t0=time.perf_counter()
+        dtype=_frame_dtype(self.header.datatype)
+        # Python ints, so that the size products below cannot overflow
+        shape=tuple(int(n) for n in (self.header.NumFrames, self.header.ydim,
+                                     self.header.xdim))
+        
+        if shape[0]*shape[1]*shape[2]==0:
+            # mmap refuses zero-length mappings
+            self.frames=np.zeros(shape, dtype=dtype)
+        else:
+            self.frames=np.memmap(fileid, dtype=dtype, mode='r',
+                                  offset=_DATA_OFFSET, shape=shape)
+        if self.stats is not None:
+            self.stats.add('read_s', time.perf_counter()-t0)
+    
+    @contextmanager
+    def _opensource(self):
+        # paths are reopened for every request, file objects are reused
+        if _ispath(self._source):
+            with open(self._source, "rb") as fd:
+                yield fd
+        else:
+            yield self._source
+    
+    def iter_frames(self, chunk=1):
+        """Yield the frames chunk at a time, re-reading them from the file.
+        
+        All chunks are read into one preallocated buffer of shape
+        (chunk, ydim, xdim) so memory use does not depend on NumFrames.
+        The yielded array is a view of that buffer and is overwritten by
+        the next step; copy it if it has to outlive the iteration.  Open
+        the file with mmap=True to avoid loading the full cube at all.
+        """
+        if self._source is None:
+            # derived files only exist in memory
+            for start in range(0, len(self.frames), max(1, chunk)):
+                yield self.frames[start:start+chunk]
+            return
+        
+        dtype=_frame_dtype(self.header.datatype)
         xdim=self.header.xdim
         ydim=self.header.ydim
         nfram=self.header.NumFrames
+        chunk=max(1, min(chunk, nfram))
+        
+        buf=np.empty((chunk, ydim, xdim,), dtype=dtype)
+        out=None if self._dtype is None else np.empty(buf.shape, self._dtype)
+        with self._opensource() as fd:
+            fd.seek(_DATA_OFFSET)
+            for start in range(0, nfram, chunk):
+                n=min(chunk, nfram-start)
+                self._read(fd, buf[:n])
+                yield self._convert(buf[:n], None if out is None else out[:n])
+    
+    def _frameoffset(self, frame, y=0):
+        hdr=self.header
+        itemsize=_frame_dtype(hdr.datatype).itemsize
+        # Python ints throughout, numpy uint16 products would wrap around
+        return _DATA_OFFSET+(int(frame)*int(hdr.ydim)+int(y))* \
+            int(hdr.xdim)*itemsize
+    
+    def read_frames(self, start=0, stop=None, step=1):
+        """Read frames[start:stop:step] by seeking straight to them."""
+        return self.read_region(slice(start, stop, step))
+    
+    def read_region(self, frame_slice, y_slice=slice(None), x_slice=slice(None)):
+        """Read frames[frame_slice, y_slice, x_slice] from the file.
         
-        data=sc.fromfile(fileid, dtype=dtype, count=nfram*xdim*ydim)
-        self.frames=sc.reshape(data,(nfram, ydim, xdim,))
+        Only the rows spanned by y_slice of the selected frames are read,
+        each frame with a single seek, so taking an ROI strip or the last
+        frames of a long run costs a fraction of a full load.  Integer
+        indices drop the corresponding axis as in numpy.
+        """
+        if self._source is None:
+            return np.array(self.frames[frame_slice, y_slice, x_slice])
+        
+        hdr=self.header
+        dtype=_frame_dtype(hdr.datatype)
+        nfram, ydim, xdim=int(hdr.NumFrames), int(hdr.ydim), int(hdr.xdim)
+        fidx, fint=_slice_indices(frame_slice, nfram)
+        yidx, yint=_slice_indices(y_slice, ydim)
+        xidx, xint=_slice_indices(x_slice, xdim)
+        
+        out=np.empty((len(fidx), len(yidx), len(xidx),), dtype=dtype)
+        if out.size:
+            y0=min(yidx)
+            sel=np.ix_(np.array(yidx)-y0, np.array(xidx))
+            buf=np.empty((max(yidx)-y0+1, xdim,), dtype=dtype)
+            full=list(yidx)==list(range(ydim)) and \
+                 list(xidx)==list(range(xdim))
+            with self._opensource() as fd:
+                if full and fidx.step==1:
+                    # a contiguous run of whole frames is a single read
+                    fd.seek(self._frameoffset(fidx[0]))
+                    self._read(fd, out)
+                    fidx=()
+                for i, frame in enumerate(fidx):
+                    fd.seek(self._frameoffset(frame, y0))
+                    if full:
+                        self._read(fd, out[i])
+                    else:
+                        self._read(fd, buf)
+                        out[i]=buf[sel]
+        
+        index=tuple(0 if isint else slice(None)
+                    for isint in (fint, yint, xint))
+        return self._convert(out)[index]
+    
+    def calibrated_axis(self, axis="x", relative=False):
+        """Evaluate the XCal or YCal calibration polynomial over all pixels.
+        
+        Pixels are numbered from 1 as in WinSpec.  With relative=True the
+        axis is converted to relative wavenumbers (cm^-1) against the
+        calibration's laser_position, taken as the laser line in nm.
+        Axes are cached by coefficients and size and shared between files,
+        so the returned array is read-only.
+        """
+        if axis=="x":
+            cal, n=self.header.XCal, self.header.xdim
+        elif axis=="y":
+            cal, n=self.header.YCal, self.header.ydim
+        else:
+            raise ValueError("axis must be 'x' or 'y', not %r" % (axis,))
+        
+        order=cal.polynom_order
+        coeffs=tuple(float(c) for c in cal.polynom_coeff[:order+1])
+        if not any(coeffs):
+            raise ValueError("file has no %s calibration" % axis)
+        laser=None
+        if relative:
+            laser=float(cal.laser_position)
+            if laser<=0:
+                raise ValueError("%s calibration has no laser position" % axis)
+        return _calibration_axis(coeffs, int(n), laser)
+    
+    def wavelengths(self):
+        """Wavelength of every x pixel, from the XCal calibration."""
+        return self.calibrated_axis("x")
+    
+    @property
+    def rois(self):
+        """The frames split into one ROI view per entry of ROIinfoblk.
+        
+        Each frame stores its ROIs one after the other, so every ROI is a
+        strided view into frames, nothing is copied.  When the ROI table
+        does not account for the frame size a single ROI spanning the
+        whole frame is returned.
+        """
+        hdr=self.header
+        nroi=min(max(1, hdr.NumROI), len(hdr.ROIinfoblk))
+        blocks=hdr.ROIinfoblk[:nroi]
+        shapes=[_roi_shape(b) for b in blocks]
+        if sum(ny*nx for ny, nx in shapes)!=hdr.xdim*hdr.ydim:
+            return [ROI(None, self.frames)]
+        
+        flat=self.frames.reshape(len(self.frames), -1)
+        rois=[]
+        offset=0
+        for block, (ny, nx) in zip(blocks, shapes):
+            view=flat[:, offset:offset+ny*nx].reshape(len(flat), ny, nx)
+            rois.append(ROI(block, view))
+            offset+=ny*nx
+        return rois
+    
+    def gate_timing(self):
+        """(delays, widths) of the pulser gate for every frame, in usec.
+        
+        In sequential mode (PulserMode 2) they run from PulseSeqStart* to
+        PulseSeqEnd* over the frames, in equal steps (PulseSeqIncMode 1)
+        or exponentially (2); in repetitive mode (PulserMode 1) every
+        frame has PulseRepDelay/PulseRepWidth.  Files that leave
+        PulserMode unset count as sequential when the start and end
+        values differ.  Computed once per file.
+        """
+        gates=getattr(self, '_gates', None)
+        if gates is None:
+            hdr=self.header
+            n=len(self.frames)
+            exp=hdr.PulseSeqIncMode==2
+            sequential=hdr.PulserMode==2
+            if hdr.PulserMode not in (1, 2):
+                sequential=hdr.PulseSeqStartDelay!=hdr.PulseSeqEndDelay or \
+                           hdr.PulseSeqStartWidth!=hdr.PulseSeqEndWidth
+            if sequential:
+                delays=_sweep(hdr.PulseSeqStartDelay, hdr.PulseSeqEndDelay, n, exp)
+                widths=_sweep(hdr.PulseSeqStartWidth, hdr.PulseSeqEndWidth, n, exp)
+            else:
+                delays=np.full(n, float(hdr.PulseRepDelay))
+                widths=np.full(n, float(hdr.PulseRepWidth))
+            delays.flags.writeable=False
+            widths.flags.writeable=False
+            gates=self._gates=(delays, widths)
+        return gates
+    
+    def select_by_delay(self, lo, hi):
+        """Read only the frames whose gate delay is within [lo, hi].
+        
+        Returns (delays, frames) of the matching frames; see gate_timing.
+        """
+        delays=self.gate_timing()[0]
+        idx=np.flatnonzero((delays>=lo)&(delays<=hi))
+        if not len(idx):
+            return delays[idx], self.read_frames(0, 0)
+        if idx[-1]-idx[0]+1==len(idx):
+            # sweeps are monotonic, so this is the usual case
+            return delays[idx], self.read_frames(idx[0], idx[-1]+1)
+        if self._source is None:
+            return delays[idx], np.array(self.frames[idx])
+        hdr=self.header
+        out=np.empty((len(idx), hdr.ydim, hdr.xdim,),
+                     dtype=_frame_dtype(hdr.datatype))
+        with self._opensource() as fd:
+            for i, frame in enumerate(idx):
+                fd.seek(self._frameoffset(frame))
+                self._read(fd, out[i])
+        return delays[idx], self._convert(out)
+    
+    def _chunks(self, chunk):
+        for start in range(0, len(self.frames), chunk):
+            yield start, self.frames[start:start+chunk]
+    
+    def sum_frames(self, dtype=np.float64, chunk=64):
+        """Sum of all frames, accumulated in dtype chunk frames at a time."""
+        acc=np.zeros(self.frames.shape[1:], dtype=dtype)
+        for start, frames in self._chunks(chunk):
+            acc+=frames.sum(axis=0, dtype=dtype)
+        return acc
+    
+    def mean_frames(self, dtype=np.float64, chunk=64):
+        """Mean frame, see sum_frames."""
+        acc=self.sum_frames(dtype, chunk)
+        acc/=max(1, len(self.frames))
+        return acc
+    
+    def median_frames(self, dtype=np.float64, chunk=64):
+        """Per-pixel median over frames.
+        
+        The median needs every frame of a pixel, so the cube is processed
+        in blocks of rows holding about as many pixels as chunk frames.
+        """
+        nfram, ydim, xdim=self.frames.shape
+        out=np.empty((ydim, xdim,), dtype=dtype)
+        rows=max(1, chunk*ydim//max(1, nfram))
+        for y in range(0, ydim, rows):
+            block=self.frames[:, y:y+rows].astype(dtype)
+            out[y:y+rows]=np.median(block, axis=0)
+        return out
+    
+    def subtract_background(self, bg=None, dtype=np.float32, chunk=64,
+                            force=False):
+        """Return a new SPECFile with a background frame subtracted.
+        
+        bg is a file name, SPECFile or array; by default the background
+        file named in the header is used.  Files with several frames are
+        averaged and cached, so a batch sharing one background reads it
+        once.  The result has BackGrndApplied set; a file that already has
+        it is refused unless force is true.
+        """
+        if self.header.BackGrndApplied and not force:
+            raise ValueError("background subtraction was already applied")
+        name, ref=self._reference(bg, self.header.background)
+        
+        result=self._derived(dtype)
+        for start, frames in self._chunks(chunk):
+            np.subtract(frames, ref, out=result.frames[start:start+chunk],
+                        casting='unsafe')
+        result.header.BackGrndApplied=1
+        if name:
+            result.header.background=name.encode('latin-1')
+        return result
+    
+    def flat_field(self, ff=None, dtype=np.float32, chunk=64, force=False):
+        """Return a new SPECFile divided by the normalised flat field.
+        
+        ff is handled like bg in subtract_background, the header's
+        FlatField name being the default, and flatFieldApplied is set.
+        """
+        if self.header.flatFieldApplied and not force:
+            raise ValueError("flat field correction was already applied")
+        name, ref=self._reference(ff, self.header.FlatField)
+        ref=ref/ref.mean()
+        
+        result=self._derived(dtype)
+        for start, frames in self._chunks(chunk):
+            np.divide(frames, ref, out=result.frames[start:start+chunk],
+                      casting='unsafe')
+        result.header.flatFieldApplied=1
+        if name:
+            result.header.FlatField=name.encode('latin-1')
+        return result
+    
+    def remove_cosmics(self, threshold=None, window=5, nsigma=5.0, chunk=64,
+                       force=False):
+        """Return a new SPECFile with cosmic ray hits replaced.
+        
+        Every frame is compared with the running median over window
+        neighbouring frames; pixels exceeding it by more than threshold
+        counts (by default the header's CosmicThreshold) are replaced by
+        that median.  Without any threshold nsigma times the per-pixel
+        median absolute deviation within the window is used.  Frames are
+        processed chunk at a time with window//2 frames of overlap.
+        """
+        if self.header.CosmicApplied and not force:
+            raise ValueError("cosmic ray removal was already applied")
+        if threshold is None and self.header.CosmicThreshold>0:
+            threshold=float(self.header.CosmicThreshold)
+        half=max(1, window//2)
+        nfram=len(self.frames)
+        
+        # float32 holds 16-bit counts exactly, wider data needs float64
+        work=np.float32 if self.frames.dtype.itemsize<=2 else np.float64
+        result=self._derived(self.frames.dtype)
+        for start in range(0, nfram, chunk):
+            stop=min(nfram, start+chunk)
+            lo, hi=max(0, start-half), min(nfram, stop+half)
+            block=np.asarray(self.frames[lo:hi], dtype=work)
+            # mirror the series at its ends so every frame has a full window
+            block=np.pad(block, ((half-(start-lo), half-(hi-stop)), (0, 0),
+                                 (0, 0)), mode='reflect')
+            n=stop-start
+            windows=np.stack([block[k:k+n] for k in range(2*half+1)])
+            med=np.median(windows, axis=0)
+            frames=block[half:half+n]
+            if threshold is None:
+                mad=np.median(abs(windows-med), axis=0)
+                hit=frames-med>nsigma*1.4826*np.maximum(mad, 1)
+            else:
+                hit=frames-med>threshold
+            # pixels that are not hit keep their original values
+            out=result.frames[start:stop]
+            out[...]=self.frames[start:stop]
+            np.copyto(out, med, where=hit, casting='unsafe')
+        
+        result.header.CosmicApplied=1
+        if threshold is not None:
+            result.header.CosmicThreshold=threshold
+        return result
+    
+    def remove_blemishes(self, blemish=None, chunk=64, force=False):
+        """Return a new SPECFile with blemished pixels interpolated.
+        
+        blemish is a file name, SPECFile or array whose non-zero pixels
+        mark bad ones, by default the blemish file named in the header
+        (loaded once and cached).  Bad pixels are linearly interpolated
+        from the nearest good pixels of the same row.
+        """
+        if self.header.BlemishApplied and not force:
+            raise ValueError("blemish removal was already applied")
+        name, ref=self._reference(blemish, self.header.blemish)
+        ys, xs, left, right, wl=_blemish_plan(ref!=0)
+        
+        result=self._derived(self.frames.dtype)
+        for start, frames in self._chunks(chunk):
+            out=result.frames[start:start+chunk]
+            out[...]=frames
+            out[:, ys, xs]=wl*frames[:, ys, left]+(1-wl)*frames[:, ys, right]
+        result.header.BlemishApplied=1
+        if name:
+            result.header.blemish=name.encode('latin-1')
+        return result
+    
+    def _reference(self, ref, default):
+        # returns (file name or None, reference frame)
+        if ref is None:
+            if not default:
+                raise ValueError("no reference file given or named in header")
+            ref=_locate(default, self._source)
+        if _ispath(ref):
+            st=os.stat(ref)
+            return ref, _reference_frame(os.path.abspath(ref), st.st_mtime,
+                                         st.st_size)
+        if isinstance(ref, SPECFile):
+            return None, ref.mean_frames()
+        return None, np.asarray(ref)
+    
+    def _derived(self, dtype):
+        # an in-memory SPECFile with a copy of the header and empty frames
+        result=SPECFile.__new__(SPECFile)
+        result._source=None
+        result.header=SPEHeader(bytearray(self.header.tobytes()))
+        result.frames=np.empty(self.frames.shape, dtype=dtype)
+        try:
+            result.header.datatype=_datatype_id(result.frames.dtype)
+        except ValueError:
+            pass
+        return result
+    
+    def pixel_series(self, y, x, cache=False):
+        """Intensity against frame number at pixel (y, x).
+        
+        y and x may also be slices, giving arrays of shape (..., NumFrames).
+        With cache=True (or a file name) the values come from a pixel-major
+        sidecar file, see pixel_cache, where every series is contiguous.
+        """
+        if cache:
+            return self.pixel_cache(None if cache is True else cache)[y, x]
+        return np.array(np.moveaxis(self.frames[:, y, x], 0, -1))
+    
+    def pixel_cache(self, path=None, chunk_bytes=1<<26):
+        """Memory-map a pixel-major (ydim, xdim, NumFrames) copy of the data.
+        
+        The copy lives in a sidecar file, path+".pxm" by default, and is
+        built in one pass over the frames, chunk_bytes of them at a time.
+        It records the mtime and size of the source, together with the
+        dtype and scaling the file was opened with, and is rebuilt when
+        they change.
+        """
+        if path is None:
+            if not _ispath(self._source):
+                raise ValueError("pixel cache needs a file name for the sidecar")
+            path=self._source+".pxm"
+        cached=getattr(self, '_pixel_cache', None)
+        if cached is not None and cached[0]==path:
+            # checked when it was opened, like self.frames it is a snapshot
+            return cached[1]
+        
+        if not self._cache_valid(path):
+            self._build_pixel_cache(path, chunk_bytes)
+        nfram, ydim, xdim=self.frames.shape
+        data=np.memmap(path, dtype=self.frames.dtype.newbyteorder('<'),
+                       mode='r', offset=dtSIDECAR.itemsize,
+                       shape=(ydim, xdim, nfram,))
+        self._pixel_cache=(path, data)
+        return data
+    
+    def _sidecar_header(self):
+        hdr=np.zeros((), dtype=dtSIDECAR)
+        hdr['magic']=_SIDECAR_MAGIC
+        if _ispath(self._source):
+            st=os.stat(self._source)
+            hdr['mtime_ns']=st.st_mtime_ns
+            hdr['size']=st.st_size
+        hdr['shape']=self.frames.shape
+        hdr['dtype']=self.frames.dtype.newbyteorder('<').str.encode('ascii')
+        hdr['scale']=self._scale
+        return hdr
+    
+    def _cache_valid(self, path):
+        try:
+            with open(path, "rb") as fd:
+                stored=fd.read(dtSIDECAR.itemsize)
+        except (IOError, OSError):
+            return False
+        return stored==self._sidecar_header().tobytes()
+    
+    def _build_pixel_cache(self, path, chunk_bytes):
+        nfram, ydim, xdim=self.frames.shape
+        dtype=self.frames.dtype.newbyteorder('<')
+        tmp=path+".tmp"
+        with open(tmp, "wb") as fd:
+            fd.write(self._sidecar_header().tobytes())
+            fd.truncate(dtSIDECAR.itemsize+nfram*ydim*xdim*dtype.itemsize)
+        if nfram*ydim*xdim:
+            out=np.memmap(tmp, dtype=dtype, mode='r+', offset=dtSIDECAR.itemsize,
+                          shape=(ydim, xdim, nfram,))
+            chunk=max(1, chunk_bytes//(ydim*xdim*dtype.itemsize))
+            # from self.frames rather than the file, they may be converted
+            for start in range(0, nfram, chunk):
+                frames=self.frames[start:start+chunk]
+                out[:, :, start:start+len(frames)]=frames.transpose(1, 2, 0)
+            out.flush()
+            del out
+        os.replace(tmp, path)
+    
+    def to_hdf5(self, path, name="frames", chunks=None, compression="gzip",
+                compression_opts=None, shuffle=True):
+        """Stream the frames into a chunked, compressed HDF5 dataset.
+        
+        Chunks default to up to 256 frames by 32x64 pixel tiles, so both
+        frame ranges and time series at fixed pixels read only a few
+        chunks.  Header fields become attributes of the dataset (nested
+        calibration fields as e.g. "XCal.offset", the raw 4100 bytes as
+        "spe_header") and the XCal axis, when calibrated, is attached as
+        the "wavelength" dimension scale.  Requires h5py.
+        
+        Files opened by name are read again chunk by chunk through
+        iter_frames; open them with mmap=True so that archives larger than
+        memory are never loaded as a whole.
+        """
+        import h5py
+        nfram, ydim, xdim=self.frames.shape
+        if chunks is None:
+            chunks=(max(1, min(nfram, 256)), max(1, min(ydim, 32)),
+                    max(1, min(xdim, 64)),)
+        
+        with h5py.File(path, "w") as h5:
+            dset=h5.create_dataset(name, shape=self.frames.shape,
+                                   dtype=self.frames.dtype, chunks=chunks,
+                                   compression=compression,
+                                   compression_opts=compression_opts,
+                                   shuffle=shuffle)
+            if _ispath(self._source):
+                blocks=self.iter_frames(chunks[0])
+            else:
+                blocks=(frames for start, frames in self._chunks(chunks[0]))
+            start=0
+            for frames in blocks:
+                dset[start:start+len(frames)]=frames
+                start+=len(frames)
+            
+            for key, value in _header_items(self.header):
+                dset.attrs[key]=value
+            dset.attrs["spe_header"]=np.void(self.header.tobytes())
+            for dim, label in zip(dset.dims, ("frame", "y", "x")):
+                dim.label=label
+            try:
+                axis=self.wavelengths()
+            except ValueError:
+                return
+            scale=h5.create_dataset("wavelength", data=axis)
+            scale.make_scale("wavelength")
+            dset.dims[2].attach_scale(scale)
     
-    def get_dtype(self,id):
+    def save(self, path, chunk=64):
+        """Write the frames and header to a new file, chunk frames at a time."""
+        with SPEWriter(path, header=self.header, dtype=self.frames.dtype) as w:
+            for start in range(0, len(self.frames), chunk):
+                w.append(self.frames[start:start+chunk])
+    
+    @staticmethod
+    def get_dtype(id):
         if id==0:
-            return sc.float32
+            return np.float32
         elif id==1:
-            return sc.int32
+            return np.int32
         elif id==2:
-            return sc.int16
+            return np.int16
         elif id==3:
-            return sc.uint16
+            return np.uint16
         else:
             return None
 
+
+class ReadStats(object):
+    """I/O statistics of one SPECFile.
+    
+    bytes_read counts the header and data bytes read from the source,
+    header_s, read_s and convert_s the time spent parsing the header,
+    reading data and reshaping or converting it.  Later reads through
+    iter_frames, read_frames or read_region are added in.  peak_bytes is
+    the peak growth of traced memory while loading, known only when
+    tracemalloc is tracing.  The peak of tracemalloc is left alone for
+    other users, so when an earlier, higher peak hides the one of the load
+    only the memory still held at the end is counted.  Allocations of
+    other threads loading at the same time are counted as well; treat the
+    value as approximate then.
+    """
+    
+    def __init__(self, path=None):
+        self.path=path
+        self.bytes_read=0
+        self.header_s=0.0
+        self.read_s=0.0
+        self.convert_s=0.0
+        self.peak_bytes=None
+        import tracemalloc
+        # (current, peak) when loading starts, None when not tracing
+        self._traced=None
+        if tracemalloc.is_tracing():
+            self._traced=tracemalloc.get_traced_memory()
+    
+    def add(self, field, seconds, nbytes=0):
+        setattr(self, field, getattr(self, field)+seconds)
+        self.bytes_read+=nbytes
+    
+    def finish(self):
+        import tracemalloc
+        if self._traced is None or not tracemalloc.is_tracing():
+            return
+        start, oldpeak=self._traced
+        current, peak=tracemalloc.get_traced_memory()
+        if peak>oldpeak:
+            # the peak was reached while loading
+            self.peak_bytes=peak-start
+        else:
+            self.peak_bytes=max(0, current-start)
+    
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in
+                    ('path', 'bytes_read', 'header_s', 'read_s', 'convert_s',
+                     'peak_bytes'))
+    
+    def __repr__(self):
+        return "ReadStats(%s)" % ", ".join("%s=%r" % item for item in
+                                          sorted(self.as_dict().items()))
+
+
+class FrameCache(object):
+    """LRU cache of decoded frames, keyed by file and frame range.
+    
+    Entries are keyed by the absolute path, mtime, size and the requested
+    (start, stop) frame range, so a file that is rewritten is never served
+    stale.  Least recently used entries are evicted once the cached frames
+    exceed max_bytes; larger reads are passed through uncached.  Returned
+    arrays are read-only and shared between callers.
+    
+    With shared=True the frames live in named shared memory segments
+    derived from the key, so other processes on the node using a shared
+    FrameCache attach to frames one of them has decoded instead of reading
+    the file again.  Each process applies its own memory budget; a segment
+    is removed when the process that created it evicts it or clears.
+    """
+    
+    def __init__(self, max_bytes=512<<20, shared=False):
+        self.max_bytes=max_bytes
+        self.shared=shared
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+        self.nbytes=0
+        self._entries=OrderedDict()
+        self._retired=[]
+        self._lock=threading.Lock()
+    
+    def get(self, path, start=0, stop=None):
+        """frames[start:stop] of the file at path, from the cache if possible."""
+        path=os.path.abspath(os.fspath(path))
+        st=os.stat(path)
+        key=(path, st.st_mtime_ns, st.st_size, start, stop)
+        with self._lock:
+            entry=self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits+=1
+                return entry[0]
         
+        entry=self._attach(key) if self.shared else None
+        if entry is None:
+            frames=SPECFile(path, mmap=True).read_frames(start, stop)
+            frames.flags.writeable=False
+            if frames.nbytes>self.max_bytes:
+                with self._lock:
+                    self.misses+=1
+                return frames
+            entry=self._share(key, frames) if self.shared else (frames, None, False)
+            hit=False
+        else:
+            hit=True
         
+        with self._lock:
+            if hit:
+                self.hits+=1
+            else:
+                self.misses+=1
+            if key in self._entries:
+                # another thread got there first
+                self._release(entry)
+                return self._entries[key][0]
+            self._entries[key]=entry
+            self.nbytes+=entry[0].nbytes
+            while self.nbytes>self.max_bytes and len(self._entries)>1:
+                old=self._entries.popitem(last=False)[1]
+                self.nbytes-=old[0].nbytes
+                self.evictions+=1
+                self._release(old)
+        return entry[0]
     
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                self._release(self._entries.popitem()[1])
+            self.nbytes=0
     
+    def info(self):
+        """Counters and size of the cache as a dict."""
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, nbytes=self.nbytes,
+                    entries=len(self._entries), max_bytes=self.max_bytes)
+    
+    def _share(self, key, frames):
+        # copy freshly read frames into a new named segment
+        from multiprocessing import shared_memory
+        meta=np.zeros((), dtype=dtSHMFRAMES)
+        meta['dtype']=frames.dtype.str.encode('ascii')
+        meta['shape']=frames.shape
+        try:
+            shm=shared_memory.SharedMemory(_shm_name(key), create=True,
+                                           size=max(1, meta.nbytes+frames.nbytes))
+        except FileExistsError:
+            entry=self._attach(key)
+            if entry is not None:
+                return entry
+            return frames, None, False
+        shm.buf[:meta.nbytes]=meta.tobytes()
+        data=np.ndarray(frames.shape, dtype=frames.dtype, buffer=shm.buf,
+                        offset=meta.nbytes)
+        data[...]=frames
+        data.flags.writeable=False
+        # flag the segment complete only now, attachers treat it as a miss
+        # until then
+        shm.buf[dtSHMFRAMES.fields['ready'][1]]=1
+        return data, shm, True
+    
+    def _attach(self, key):
+        from multiprocessing import shared_memory
+        # only the creator may unlink a segment, but before Python 3.13 an
+        # attaching process registers it with its resource tracker as
+        # well, which would unlink it for everybody when the process exits
+        name=_shm_name(key)
+        kwargs={'track': False} if sys.version_info>=(3, 13) else {}
+        try:
+            shm=shared_memory.SharedMemory(name, **kwargs)
+        except FileNotFoundError:
+            return None
+        if not kwargs:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        meta=np.frombuffer(shm.buf, dtype=dtSHMFRAMES, count=1)[0]
+        try:
+            if not meta['ready']:
+                # still being filled by another process
+                raise ValueError('segment not ready')
+            dtype=np.dtype(meta['dtype'].decode('ascii'))
+            shape=tuple(int(n) for n in meta['shape'])
+            data=np.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                            offset=dtSHMFRAMES.itemsize)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            del meta
+            shm.close()
+            return None
+        del meta
+        data.flags.writeable=False
+        return data, shm, False
+    
+    def _release(self, entry):
+        frames, shm, owner=entry
+        if shm is None:
+            return
+        if owner:
+            if sys.version_info<(3, 13):
+                # an attaching process sharing our resource tracker (one
+                # started by multiprocessing) has unregistered the segment,
+                # unlink() would make the tracker complain
+                from multiprocessing import resource_tracker
+                resource_tracker.register(shm._name, "shared_memory")
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                # removed behind our back, e.g. by another resource tracker
+                pass
+        # a segment can only be closed once no array uses it any more
+        self._retired.append(shm)
+        retired=[]
+        for shm in self._retired:
+            try:
+                shm.close()
+            except BufferError:
+                retired.append(shm)
+        self._retired=retired
+
+
+def _shm_name(key):
+    return "spe_"+hashlib.sha1(repr(key).encode()).hexdigest()[:24]
+
+
+_frame_cache=None
+
+
+def frame_cache(max_bytes=None, shared=None):
+    """The process-wide FrameCache used by SPECFile(path, cache=True).
+    
+    It is created on first use; max_bytes and shared replace it with a
+    new, empty cache of that configuration.
+    """
+    global _frame_cache
+    if _frame_cache is None or max_bytes is not None or shared is not None:
+        if _frame_cache is not None:
+            _frame_cache.clear()
+            max_bytes=_frame_cache.max_bytes if max_bytes is None else max_bytes
+            shared=_frame_cache.shared if shared is None else shared
+        _frame_cache=FrameCache(512<<20 if max_bytes is None else max_bytes,
+                                bool(shared))
+    return _frame_cache
+
+
+_stats_callback=None
+
+
+def set_stats_callback(func):
+    """Instrument every SPECFile opened without an explicit stats argument.
+    
+    func receives the ReadStats of each loaded file, e.g. to export them
+    as metrics; True only collects them, None turns instrumentation off.
+    Returns the previous setting.
+    """
+    global _stats_callback
+    previous, _stats_callback=_stats_callback, func
+    return previous
+
+
+class ROI(object):
+    """One region of interest: its frames and chip coordinates.
+    
+    frames has shape (NumFrames, ny, nx); x and y hold the chip pixel
+    position (1-based, centre of the bin) of every column and row.
+    """
+    
+    def __init__(self, block, frames):
+        self.frames=frames
+        nfram, ny, nx=frames.shape
+        if block is None:
+            self.startx, self.endx, self.groupx=1, nx, 1
+            self.starty, self.endy, self.groupy=1, ny, 1
+        else:
+            self.startx, self.endx=int(block.startx), int(block.endx)
+            self.starty, self.endy=int(block.starty), int(block.endy)
+            self.groupx=max(1, int(block.groupx))
+            self.groupy=max(1, int(block.groupy))
+        self.x=self.startx+self.groupx*np.arange(nx)+(self.groupx-1)/2
+        self.y=self.starty+self.groupy*np.arange(ny)+(self.groupy-1)/2
+    
+    def __repr__(self):
+        return "ROI(x=%d:%d/%d, y=%d:%d/%d, shape=%s)" % (
+            self.startx, self.endx, self.groupx, self.starty, self.endy,
+            self.groupy, self.frames.shape)
+
+
+def _header_items(record, prefix=""):
+    """(name, decoded value) of every header field, nested ones flattened."""
+    for name in record.dtype.names:
+        value=getattr(record, name)
+        if isinstance(value, _Record):
+            for item in _header_items(value, prefix+name+"."):
+                yield item
+        else:
+            yield prefix+name, value
+
+
+def _roi_shape(block):
+    """(ny, nx) of the data stored for one ROIinfo entry."""
+    nx=(int(block.endx)-int(block.startx)+1)//max(1, int(block.groupx))
+    ny=(int(block.endy)-int(block.starty)+1)//max(1, int(block.groupy))
+    return max(0, ny), max(0, nx)
+
+
+class SPEWriter(object):
+    """Write a WinView/WinSpec file frame by frame.
+    
+    The header is written when the file is opened and patched with
+    NumFrames and MaxIntensity/MinIntensity on close, so frames can be
+    appended without ever holding the whole cube.  header may be an
+    SPEHeader to copy the remaining fields from; xdim, ydim and dtype
+    default to its values.  Use as a context manager or call close().
+    """
+    
+    def __init__(self, path, xdim=None, ydim=None, dtype=None, header=None):
+        if header is None:
+            self.header=SPEHeader(bytearray(_DATA_OFFSET))
+            self.header.WinView_id=0x01234567
+            self.header.lastvalue=0x5555
+            self.header.file_header_ver=2.5
+        else:
+            self.header=SPEHeader(bytearray(header.tobytes()))
+            if xdim is None:
+                xdim=self.header.xdim
+            if ydim is None:
+                ydim=self.header.ydim
+            if dtype is None:
+                dtype=SPECFile.get_dtype(self.header.datatype)
+        if not xdim or not ydim:
+            raise ValueError("frame dimensions are not known")
+        
+        self.dtype=np.dtype(np.uint16 if dtype is None else dtype)
+        self.header.datatype=_datatype_id(self.dtype)
+        self.header.xdim=xdim
+        self.header.ydim=ydim
+        self.header.NumFrames=0
+        self._min=None
+        self._max=None
+        self._fd=open(path, "wb")
+        self._fd.write(self.header.tobytes())
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def append(self, frames):
+        """Append one (ydim, xdim) frame or a (n, ydim, xdim) stack."""
+        frames=np.asarray(frames)
+        shape=(self.header.ydim, self.header.xdim,)
+        if frames.shape==shape:
+            frames=frames[None]
+        if frames.shape[1:]!=shape:
+            raise ValueError("frames of shape %s do not fit %s" %
+                             (frames.shape, shape))
+        if not len(frames):
+            return
         
+        data=np.ascontiguousarray(frames, dtype=self.dtype.newbyteorder('<'))
+        lo, hi=float(data.min()), float(data.max())
+        self._min=lo if self._min is None else min(self._min, lo)
+        self._max=hi if self._max is None else max(self._max, hi)
+        self._fd.write(memoryview(data).cast('B'))
+        self.header.NumFrames+=len(frames)
+    
+    def close(self):
+        if self._fd.closed:
+            return
+        if self._min is not None:
+            self.header.MinIntensity=self._min
+            self.header.MaxIntensity=self._max
+        self._fd.seek(0)
+        self._fd.write(self.header.tobytes())
+        self._fd.close()
+
+
+@lru_cache(maxsize=16)
+def _reference_frame(path, mtime, size):
+    # mean frame of a background/flat field file; mtime and size are only
+    # part of the cache key so that a rewritten file is read again
+    ref=SPECFile(path, mmap=True).mean_frames()
+    ref.flags.writeable=False
+    return ref
+
+
+def _blemish_plan(mask):
+    """Pixel and neighbour indices with weights to interpolate bad pixels."""
+    ydim, xdim=mask.shape
+    x=np.arange(xdim)
+    left=np.maximum.accumulate(np.where(mask, -1, x), axis=1)
+    right=np.minimum.accumulate(np.where(mask, xdim, x)[:, ::-1], axis=1)[:, ::-1]
+    ys, xs=np.nonzero(mask)
+    left, right=left[ys, xs], right[ys, xs]
+    # at the row ends take the only good neighbour, drop fully bad rows
+    left=np.where(left<0, right, left)
+    right=np.where(right>=xdim, left, right)
+    keep=(left>=0)&(left<xdim)
+    ys, xs, left, right=ys[keep], xs[keep], left[keep], right[keep]
+    span=np.maximum(right-left, 1)
+    wl=np.where(right==left, 1.0, (right-xs)/span)
+    return ys, xs, left, right, wl
+
+
+def _locate(name, source):
+    """Find a file named in the header, next to source if not as given."""
+    if os.path.exists(name):
+        return name
+    base=name.replace('\\', '/').rsplit('/', 1)[-1]
+    if _ispath(source):
+        path=os.path.join(os.path.dirname(source), base)
+        if os.path.exists(path):
+            return path
+    raise IOError("reference file %r not found" % (name,))
+
+
+def _frame_dtype(datatype):
+    """Little-endian dtype of the data for a header datatype code."""
+    dtype=SPECFile.get_dtype(datatype)
+    if dtype is None:
+        raise ValueError("unknown data type %r in header" % (datatype,))
+    return np.dtype(dtype).newbyteorder('<')
+
+
+def _datatype_id(dtype):
+    """Header datatype code of a numpy dtype, the inverse of get_dtype."""
+    dtype=np.dtype(dtype).newbyteorder('=')
+    for id in range(4):
+        if np.dtype(SPECFile.get_dtype(id))==dtype:
+            return id
+    raise ValueError("dtype %s cannot be stored in a .spe file" % (dtype,))
+
+
+def _ispath(arg):
+    return isinstance(arg, (str, os.PathLike))
+
+
+def read_header(arg):
+    """Read only the 4100-byte header from a path or an open binary file."""
+    if _ispath(arg):
+        with open(arg, "rb") as fd:
+            return read_header(fd)
+    return SPEHeader(_readinto(arg, bytearray(_DATA_OFFSET)))
+
+
+def _readinto(fd, out):
+    """Fill the contiguous array or writable buffer out with bytes from fd."""
+    mv=memoryview(out).cast('B')
+    pos=0
+    while pos<len(mv):
+        if hasattr(fd, 'readinto'):
+            n=fd.readinto(mv[pos:])
+        else:
+            data=fd.read(len(mv)-pos)
+            n=len(data)
+            mv[pos:pos+n]=data
+        if not n:
+            raise IOError("unexpected end of file, %d of %d bytes read" %
+                          (pos, len(mv)))
+        pos+=n
+    return out
+
+
+class _BufferFile(object):
+    """Minimal seekable binary stream over a memoryview, used by from_buffer."""
+    
+    def __init__(self, mv):
+        self._mv=mv
+        self._pos=0
+    
+    def seek(self, pos, whence=0):
+        if whence==1:
+            pos+=self._pos
+        elif whence==2:
+            pos+=len(self._mv)
+        self._pos=max(0, pos)
+        return self._pos
+    
+    def tell(self):
+        return self._pos
+    
+    def readinto(self, out):
+        out=memoryview(out).cast('B')
+        data=self._mv[self._pos:self._pos+len(out)]
+        out[:len(data)]=data
+        self._pos+=len(data)
+        return len(data)
+    
+    def read(self, n=-1):
+        end=len(self._mv) if n<0 else self._pos+n
+        data=self._mv[self._pos:end].tobytes()
+        self._pos+=len(data)
+        return data
+
+
+def _slice_indices(s, n):
+    """Return (range of indices, is_integer) for an int or slice over n."""
+    if isinstance(s, slice):
+        return range(*s.indices(n)), False
+    i=int(s)
+    if i<0:
+        i+=n
+    if not 0<=i<n:
+        raise IndexError("index %d is out of bounds for size %d" % (s, n))
+    return range(i, i+1), True
+
+
+def _sweep(start, end, n, exponential=False):
+    """n values from start to end, in equal or in constant-ratio steps."""
+    t=np.linspace(0, 1, n) if n>1 else np.zeros(n)
+    if exponential and start>0 and end>0:
+        return start*(end/start)**t
+    return start+(end-start)*t
+
+
+@lru_cache(maxsize=64)
+def _calibration_axis(coeffs, n, laser=None):
+    # coeffs are in increasing order, polyval wants the highest first
+    axis=np.polyval(coeffs[::-1], np.arange(1, n+1, dtype=np.float64))
+    if laser is not None:
+        axis=1e7/laser-1e7/axis
+    axis.flags.writeable=False
+    return axis
+
+
+def _index_row(path, st):
+    hdr=read_header(path)
+    cal=hdr.XCal
+    # the raw bytes of date, its decoded str may not be ASCII
+    return (path, st.st_mtime, st.st_size, hdr.xdim, hdr.ydim,
+            hdr.NumFrames, hdr.datatype, hdr.record.date, hdr.exp_sec,
+            cal.polynom_order, cal.calib_count,
+            cal.polynom_coeff, cal.pixel_position, cal.calib_value,
+            cal.laser_position)
+
+
+def load_index(index_path):
+    """Load a table written by index_directory."""
+    with open(index_path, "rb") as fd:
+        return np.load(fd)['index']
+
+
+def index_directory(directory, index_path=None, pattern='*.spe'):
+    """Build a metadata table with one row per .spe file below directory.
+    
+    Only headers are read; files that cannot be read are skipped with a
+    warning.  If index_path names an existing index, files
+    whose mtime and size did not change are taken from it instead of being
+    re-read; the updated table is written back to index_path as .npz.
+    """
+    old={}
+    if index_path is not None and os.path.exists(index_path):
+        for row in load_index(index_path):
+            old[row['path']]=row
+    
+    rows=[]
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if not fnmatch.fnmatch(name.lower(), pattern.lower()):
+                continue
+            path=os.path.join(root, name)
+            try:
+                st=os.stat(path)
+                prev=old.get(path)
+                if prev is not None and prev['mtime']==st.st_mtime and \
+                        prev['size']==st.st_size:
+                    rows.append(prev.tolist())
+                else:
+                    rows.append(_index_row(path, st))
+            except (IOError, OSError, ValueError) as err:
+                # truncated, unreadable or not a .spe file after all
+                warnings.warn("skipping %s: %s" % (path, err))
+    
+    pathlen=max([len(r[0]) for r in rows]+[1])
+    table=np.array(rows, dtype=[('path','U%d' % pathlen)]+_INDEX)
+    if index_path is not None:
+        with open(index_path, "wb") as fd:
+            np.savez(fd, index=table)
+    return table
+
+        
+        
+    
+    
+        
+def follow(path, poll=0.05, timeout=None):
+    """Yield (index, frame) as frames are appended to a file being acquired.
+    
+    The header is read once and the file size polled every poll seconds;
+    each frame is read as soon as it is complete, from a cursor that only
+    moves forward, so earlier frames are never read again.  NumFrames is
+    ignored since it may only be written at the end of the acquisition.
+    The generator returns once no new frame has arrived for timeout
+    seconds, or runs until closed if timeout is None.
+    """
+    with open(path, "rb") as fd:
+        last=time.time()
+        while os.fstat(fd.fileno()).st_size<_DATA_OFFSET:
+            if timeout is not None and time.time()-last>=timeout:
+                return
+            time.sleep(poll)
+        header=read_header(fd)
+        dtype=_frame_dtype(header.datatype)
+        shape=(int(header.ydim), int(header.xdim),)
+        framesize=shape[0]*shape[1]*dtype.itemsize
+        if not framesize:
+            raise ValueError("header of %r has no frame size" % (path,))
+        
+        index=0
+        last=time.time()
+        while True:
+            available=(os.fstat(fd.fileno()).st_size-_DATA_OFFSET)//framesize
+            if available>index:
+                fd.seek(_DATA_OFFSET+index*framesize)
+                for index in range(index, available):
+                    yield index, _readinto(fd, np.empty(shape, dtype=dtype))
+                index=available
+                last=time.time()
+            elif timeout is not None and time.time()-last>=timeout:
+                return
+            else:
+                time.sleep(poll)
+
+
+_max_open_files=16
+_semaphores=weakref.WeakKeyDictionary()
+
+
+def max_open_files(n=None):
+    """Return, or set with n, the per event loop limit of files read by
+    SPECFile.aopen and aiter_frames at the same time."""
+    global _max_open_files
+    if n is not None:
+        _max_open_files=int(n)
+        _semaphores.clear()
+    return _max_open_files
+
+
+def _open_semaphore():
+    import asyncio
+    loop=asyncio.get_running_loop()
+    sem=_semaphores.get(loop)
+    if sem is None:
+        sem=_semaphores[loop]=asyncio.Semaphore(_max_open_files)
+    return sem
+
+
+def _load_batch(paths, func, kwargs):
+    # runs in the worker; module level so the process backend can pickle it
+    results=[]
+    for path in paths:
+        f=SPECFile(path, **kwargs)
+        results.append((path, f if func is None else func(f)))
+    return results
+
+
+def iter_many(paths, workers=None, backend="thread", func=None,
+              chunksize=None, **kwargs):
+    """Open many files concurrently, yielding (path, result) as each finishes.
+    
+    result is the SPECFile, or func(SPECFile) when func is given; any extra
+    keyword arguments go to SPECFile.  backend="thread" suits I/O bound
+    loading, backend="process" per-file reductions heavy enough to be CPU
+    bound, in which case func has to be picklable (a module level function)
+    and paths are sent to the workers in batches of chunksize.
+    """
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+        as_completed
+    paths=list(paths)
+    if backend=="thread":
+        pool=ThreadPoolExecutor
+        chunksize=chunksize or 1
+    elif backend=="process":
+        pool=ProcessPoolExecutor
+        if chunksize is None:
+            chunksize=max(1, len(paths)//(4*(workers or os.cpu_count() or 1)))
+    else:
+        raise ValueError("backend must be 'thread' or 'process', not %r" %
+                         (backend,))
+    
+    with pool(max_workers=workers) as executor:
+        futures=[executor.submit(_load_batch, paths[i:i+chunksize], func,
+                                 kwargs)
+                 for i in range(0, len(paths), chunksize)]
+        for future in as_completed(futures):
+            for item in future.result():
+                yield item
+
+
+def load_many(paths, workers=None, backend="thread", func=None, stack=False,
+              chunksize=None, **kwargs):
+    """Open many files concurrently and return the results in input order.
+    
+    See iter_many for the arguments.  With stack=True the frames of all
+    files (or the func results) are joined into a single array along the
+    first axis.
+    """
+    paths=list(paths)
+    results=dict(iter_many(paths, workers, backend, func, chunksize,
+                           **kwargs))
+    results=[results[path] for path in paths]
+    if stack:
+        if func is None:
+            return np.concatenate([f.frames for f in results])
+        return np.array(results)
+    return results
+
+
+def glue(files, start=None, stop=None, step=None, squeeze=True):
+    """Glue calibrated spectra (step-and-glue segments) onto one grid.
+    
+    files are paths or SPECFile objects with an x calibration and equal
+    numbers of frames and rows.  The grid runs from start to stop in steps
+    of step, by default the SpecGlueStartWlNm/SpecGlueStopWlNm/
+    SpecGlueFinalResNm of the first file when set, else the span of the
+    segments and their finest pixel spacing.  Every segment is linearly
+    resampled and overlaps are cross-faded with weights falling off
+    towards each segment's edges, all segments in one vectorized pass.
+    Returns (grid, data) with data of shape (NumFrames, ydim, len(grid)),
+    NaN where no segment reaches; squeeze drops unit frame/row axes so a
+    single spectrum comes back 1-D.  A gap or overlap below
+    SpecGlueMinOvelpNm between neighbouring segments gives a warning.
+    """
+    files=[f if isinstance(f, SPECFile) else SPECFile(f, mmap=True)
+           for f in files]
+    if not files:
+        raise ValueError("nothing to glue")
+    axes, data=[], []
+    for f in files:
+        w=np.asarray(f.wavelengths())
+        d=np.asarray(f.frames, dtype=np.float64)
+        if len(w)<2:
+            raise ValueError("segments need at least two pixels")
+        if w[0]>w[-1]:
+            w, d=w[::-1], d[..., ::-1]
+        axes.append(w)
+        data.append(d)
+    if len(set(d.shape[:2] for d in data))>1:
+        raise ValueError("segments differ in number of frames or rows")
+    
+    hdr=files[0].header
+    if start is None:
+        start=hdr.SpecGlueStartWlNm if hdr.SpecGlueStartWlNm>0 else \
+            min(w[0] for w in axes)
+    if stop is None:
+        stop=hdr.SpecGlueStopWlNm if hdr.SpecGlueStopWlNm>start else \
+            max(w[-1] for w in axes)
+    if step is None:
+        step=hdr.SpecGlueFinalResNm if hdr.SpecGlueFinalResNm>0 else \
+            min(np.diff(w).min() for w in axes if len(w)>1)
+    grid=np.arange(start, stop+step/2, step)
+    
+    order=np.argsort([w[0] for w in axes])
+    for a, b in zip(order[:-1], order[1:]):
+        overlap=axes[a][-1]-axes[b][0]
+        if overlap<max(0, hdr.SpecGlueMinOvelpNm):
+            warnings.warn("segments %d and %d overlap by %.3g nm only" %
+                          (a, b, overlap))
+    
+    # for every segment the grid points it covers, as one flat list of
+    # (grid index, left pixel in the concatenated data, fraction, weight)
+    gidx, left, frac, weight=[], [], [], []
+    offset=0
+    for w in axes:
+        lo=np.searchsorted(grid, w[0], side='left')
+        hi=np.searchsorted(grid, w[-1], side='right')
+        g=grid[lo:hi]
+        i=np.clip(np.searchsorted(w, g, side='right')-1, 0, len(w)-2)
+        gidx.append(np.arange(lo, hi))
+        left.append(offset+i)
+        frac.append((g-w[i])/(w[i+1]-w[i]))
+        weight.append(np.maximum(np.minimum(g-w[0], w[-1]-g), 1e-3*step))
+        offset+=len(w)
+    gidx, left, frac, weight=[np.concatenate(a) for a in
+                              (gidx, left, frac, weight)]
+    
+    cat=np.concatenate(data, axis=-1)
+    values=(cat[..., left]*(1-frac)+cat[..., left+1]*frac)*weight
+    
+    # sum the contributions per grid point
+    out=np.full(cat.shape[:-1]+(len(grid),), np.nan)
+    if len(gidx):
+        sort=np.argsort(gidx, kind='stable')
+        gidx, values, weight=gidx[sort], values[..., sort], weight[sort]
+        first=np.flatnonzero(np.r_[True, gidx[1:]!=gidx[:-1]])
+        out[..., gidx[first]]=np.add.reduceat(values, first, axis=-1)/ \
+            np.add.reduceat(weight, first)
+    if squeeze:
+        out=out.reshape([n for n in out.shape[:-1] if n!=1]+[len(grid)])
+    return grid, out
+
 
 _ROI=[
     ('startx','u2'),\
@@ -389,30 +2023,30 @@ _ROI=[
     ('endy','u2'),\
     ('groupy','u2'),\
 ]
-dtROI=sc.dtype(_ROI)
+dtROI=np.dtype(_ROI)
 
 _CAL_STRUCT=[
-    ('offset',sc.float64),\
+    ('offset',np.float64),\
     ('factor','f8'),\
-    ('current_unit','a1'),\
-    ('reserved1','a1'),\
-    ('string','a40'),\
-    ('reserved2','a40'),\
-    ('calib_valid','a1'),\
-    ('input_unit','a1'),\
-    ('polynom_unit','a1'),\
-    ('polynom_order','a1'),\
-    ('calib_count','a1'),\
+    ('current_unit','u1'),\
+    ('reserved1','S1'),\
+    ('string','S40'),\
+    ('reserved2','S40'),\
+    ('calib_valid','u1'),\
+    ('input_unit','u1'),\
+    ('polynom_unit','u1'),\
+    ('polynom_order','u1'),\
+    ('calib_count','u1'),\
     ('pixel_position','(10,) f8'),\
     ('calib_value','(10,) f8'),\
     ('polynom_coeff','(6,) f8'),\
     ('laser_position','f8'),\
-    ('reserved3','a1'),\
-    ('new_calib_flag','b'),\
-    ('calib_label','a81'),\
-    ('expansion','a87'),\
+    ('reserved3','S1'),\
+    ('new_calib_flag','u1'),\
+    ('calib_label','S81'),\
+    ('expansion','S87'),\
 ]
-dtCAL=sc.dtype(_CAL_STRUCT)
+dtCAL=np.dtype(_CAL_STRUCT)
 
 
     
@@ -426,9 +2060,9 @@ _HEADER_1 = [
     ('VChipXdim','i2'),\
     ('VChipYdim','i2'),\
     ('yDimDet','u2'),\
-    ('date','a10'),\
+    ('date','S10'),\
     ('VirtualChipFlag','i2'),\
-    ('Spare_1','a2'),\
+    ('Spare_1','S2'),\
     ('noscan','i2'),\
     ('DetTemperature','f4'),\
     ('DetType','i2'),\
@@ -438,13 +2072,13 @@ _HEADER_1 = [
     ('ShutterControl','u2'),\
     ('AbsorbLive','i2'),\
     ('AbsorbMode','u2'),\
-    ('CAnDoVirtualChipFlag','i2'),\
+    ('CanDoVirtualChipFlag','i2'),\
     ('ThresholdMinLive','i2'),\
     ('ThresholdMinVal','f4'),\
     ('ThresholdMaxLive','i2'),\
     ('ThresholdMaxVal','f4'),\
     ('SpecAutoSpectroMode','i2'),\
-    ('SpecSenterWlNm', 'f4'),\
+    ('SpecCenterWlNm', 'f4'),\
     ('SpecGlueFlag','i2'),\
     ('SpecGlueStartWlNm','f4'),\
     ('SpecGlueStopWlNm','f4'),\
@@ -478,8 +2112,8 @@ _HEADER_1 = [
     ('SpecMirrorLocation','(2,) i2'),\
     ('SpecSlitLocation','(4,) i2'),\
     ('CustomTimingFlag','i2'),\
-    ('ExperimentTimeLocal','a7'),\
-    ('ExperimentTimeUTC','a7'),\
+    ('ExperimentTimeLocal','S7'),\
+    ('ExperimentTimeUTC','S7'),\
     ('ExposUnits','i2'),\
     ('ADCoffset','u2'),\
     ('ADCrate','u2'),\
@@ -487,9 +2121,9 @@ _HEADER_1 = [
     ('ADCresolution','u2'),\
     ('ADCbitAdjust','u2'),\
     ('gain','u2'),\
-    ('Comments','(5,) a80'),\
+    ('Comments','(5,) S80'),\
     ('geometric','u2'),\
-    ('xlabel','a16'),\
+    ('xlabel','S16'),\
     ('cleans','u2'),\
     ('NumSkpPerCln','u2'),\
     ('SpecMirrorPos','(2,) i2'),\
@@ -508,16 +2142,16 @@ _HEADER_1 = [
     ('lavgexp','i4'),\
     ('ReadoutTime','f4'),\
     ('TriggerModeFlag','i2'),\
-    ('Spare_2','a10'),\
-    ('sw_version','a16'),\
+    ('Spare_2','S10'),\
+    ('sw_version','S16'),\
     ('type','i2'),\
     ('flatFieldApplied','i2'),\
-    ('Spare_3','a16'),\
+    ('Spare_3','S16'),\
     ('kin_trig_mode','i2'),\
-    ('dlabel','a16'),\
-    ('Spare_4','a436'),\
-    ('PulseFileName','a120'),\
-    ('AbsorbFileName','a120'),\
+    ('dlabel','S16'),\
+    ('Spare_4','S436'),\
+    ('PulseFileName','S120'),\
+    ('AbsorbFileName','S120'),\
     ('NumExpRepeats','u4'),\
     ('NumExpAccums','u4'),\
     ('YT_Flag', 'i2'),\
@@ -531,36 +2165,36 @@ _HEADER_1 = [
     ('NumFrames','i4'),\
     ('MaxIntensity','f4'),\
     ('MinIntensity','f4'),\
-    ('ylabel','a16'),\
+    ('ylabel','S16'),\
     ('ShutterType','u2'),\
-    ('shuttterComp','f4'),\
+    ('shutterComp','f4'),\
     ('readoutMode','u2'),\
     ('WindowSize','u2'),\
     ('clkspd','u2'),\
     ('interface_type','u2'),\
     ('NumROIsInExperiment','i2'),\
-    ('Sparse_5','a16'),\
+    ('Spare_5','S16'),\
     ('controllerNum','u2'),\
     ('SWmade','u2'),\
     ('NumROI','i2'),\
     ('ROIinfoblk', (dtROI, 10) ),\
-    ('FlatField','a120'),\
-    ('background','a120'),\
-    ('blebish','a120'),\
+    ('FlatField','S120'),\
+    ('background','S120'),\
+    ('blemish','S120'),\
     ('file_header_ver','f4'),\
-    ('YT_info','a1000'),\
+    ('YT_info','S1000'),\
     ('WinView_id','i4'),\
     ('XCal', dtCAL),\
     ('YCal', dtCAL),\
-    ('IString', 'a40'),\
-    ('Spare_6', 'a25'),\
-    ('SpecType','b'),\
-    ('SpecModel','b'),\
-    ('PulseBurstUsed','b'),\
+    ('IString', 'S40'),\
+    ('Spare_6', 'S25'),\
+    ('SpecType','u1'),\
+    ('SpecModel','u1'),\
+    ('PulseBurstUsed','u1'),\
     ('PulseBurstCount','u4'),\
     ('PulseBurstPeriod','f8'),\
-    ('PulseBracketUsed','b'),\
-    ('PulseBracketType','b'),\
+    ('PulseBracketUsed','u1'),\
+    ('PulseBracketType','u1'),\
     ('PulseTimeConstFast','f8'),\
     ('PulseAmplitudeFast','f8'),\
     ('PulseTimeConstSlow','f8'),\
@@ -570,6 +2204,58 @@ _HEADER_1 = [
     ('AvGain','i2'),\
     ('lastvalue','i2'),\
 ]
+dtHEADER=np.dtype(_HEADER_1)
+assert dtHEADER.itemsize==_DATA_OFFSET, "header layout is not 4100 bytes"
+
+# misspelled field names used by earlier versions of this module
+_HEADER_ALIASES={
+    'CAnDoVirtualChipFlag':'CanDoVirtualChipFlag',\
+    'SpecSenterWlNm':'SpecCenterWlNm',\
+    'shuttterComp':'shutterComp',\
+    'Sparse_5':'Spare_5',\
+    'blebish':'blemish',\
+}
+
+
+# columns of the table built by index_directory (after the 'path' column)
+_INDEX = [
+    ('mtime','f8'),\
+    ('size','i8'),\
+    ('xdim','u2'),\
+    ('ydim','u2'),\
+    ('NumFrames','i4'),\
+    ('datatype','i2'),\
+    ('date','S10'),\
+    ('exp_sec','f4'),\
+    ('polynom_order','u1'),\
+    ('calib_count','u1'),\
+    ('polynom_coeff','(6,) f8'),\
+    ('pixel_position','(10,) f8'),\
+    ('calib_value','(10,) f8'),\
+    ('laser_position','f8'),\
+]
+
+
+# header of the pixel-major sidecar written by SPECFile.pixel_cache, the
+# data follows it; mtime_ns and size are those of the source file
+_SIDECAR_MAGIC=b'SPEPXM2'
+_SIDECAR = [
+    ('magic','S8'),\
+    ('mtime_ns','i8'),\
+    ('size','i8'),\
+    ('shape','(3,) i8'),\
+    ('dtype','S8'),\
+    ('scale','(2,) f8'),\
+]
+dtSIDECAR=np.dtype(_SIDECAR)
+
+# header of a shared memory segment of FrameCache, the frames follow it
+_SHMFRAMES = [
+    ('dtype','S8'),\
+    ('shape','(3,) i8'),\
+    ('ready','u1'),\
+]
+dtSHMFRAMES=np.dtype(_SHMFRAMES)
 
 
 if __name__=="__main__":